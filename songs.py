@@ -1,170 +1,915 @@
-from google.cloud import storage, bigquery
-from datetime import datetime
-import requests
-from bs4 import BeautifulSoup
-import pandas as pd
+from datetime import date, datetime, timedelta, timezone
+from urllib.parse import quote
+import google.auth
+import google.auth.transport.urllib3
+import urllib3
+import httpx
+from lxml import etree
+import lxml.html
+import asyncio
 import logging
-
-URL = 'https://www.971theriver.com/lsp/'
+import csv
+import gzip
+import io
+import json
+import threading
+import time
+import uuid
+
+URLS = ['https://www.971theriver.com/lsp/']
 GCS_BUCKET_NAME = 'the-river-songs'
 GCS_ARCHIVE_BUCKET_NAME = 'the-river-songs-archive'
 FILE_BASE_NAME = 'songlist'
+HTTP_CACHE_FILE_NAME = 'http_cache.json'
 BQ_PROJECT_NAME = 'calm-collective-205117'
 TABLE_NAME = 'SONGS'
+SONG_CLASS = 'lsp-item-title bold font_size_sm'
+ARTIST_CLASS = 'lsp-item-artist font_size_sm'
+LOOKBACK_DAYS = 2
+MAX_CONCURRENT_REQUESTS = 10
+REQUEST_TIMEOUT = 10
+MAX_RETRIES = 3
+BACKOFF_FACTOR = 0.3
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+NON_PERMANENT_CLIENT_ERRORS = {408, 429}
+API_SCOPE = 'https://www.googleapis.com/auth/cloud-platform'
+API_TIMEOUT = 60
+GCS_API_URL = 'https://storage.googleapis.com'
+BQ_API_URL = 'https://bigquery.googleapis.com/bigquery/v2'
+BQ_POLL_TIMEOUT_MS = 10000
+BQ_POLL_INTERVAL = 1
+BQ_DATA_TRANSFER_API_URL = 'https://bigquerydatatransfer.googleapis.com/v1'
+BQ_LOCATION = 'us'
+BQ_CONNECTION_NAME = 'songs-remote'
+REMOTE_FUNCTION_NAME = f'{BQ_PROJECT_NAME}.RAW_DATA.GET_PLAYLIST'
+REMOTE_FUNCTION_ENDPOINT = f'https://us-central1-{BQ_PROJECT_NAME}.cloudfunctions.net/bq_get_playlist'
+SCHEDULE = 'every 15 minutes'
+SCHEDULED_QUERY_NAME = f'{TABLE_NAME} DATAMART load'
+
+# Deterministic INT64 key for a play, so DATAMART dedup is a single integer
+# compare. Built from DATAMART's own columns so existing rows can be backfilled.
+ROW_ID_SQL = 'FARM_FINGERPRINT(TO_JSON_STRING(STRUCT(Song, Artist, DatePlayed, TimePlayed)))'
+
+PLAYLIST_XPATH = etree.XPath(
+    f"//time | //div[normalize-space(@class) = '{SONG_CLASS}' or normalize-space(@class) = '{ARTIST_CLASS}']"
+)
 
 logger = logging.Logger(__name__)
 
-def get_data(url: str) -> tuple[list, list, list]:
+_credentials = None
+_credentials_lock = threading.Lock()
+_auth_request = google.auth.transport.urllib3.Request(urllib3.PoolManager())
+_api_client = None
+
+def get_access_token() -> str:
+
+    '''
+    Return an OAuth access token for the default credentials. The
+    credentials are loaded once per process and only refreshed when the
+    cached token has expired, so warm starts skip the auth round trip. The
+    lock stops concurrent worker threads loading or refreshing them twice.
+    '''
+
+    global _credentials
+
+    with _credentials_lock:
+        if _credentials is None:
+            _credentials, _ = google.auth.default(scopes=[API_SCOPE])
+
+        if not _credentials.valid:
+            _credentials.refresh(_auth_request)
+
+        return _credentials.token
+
+def get_api_client() -> httpx.Client:
+
+    '''
+    Return the process-wide HTTP client used for the GCS and BigQuery REST
+    APIs, creating it on first use so warm starts reuse its connections. Its
+    transport retries failed connection attempts.
+    '''
+
+    global _api_client
+
+    if _api_client is None:
+        transport = httpx.HTTPTransport(retries=MAX_RETRIES)
+        _api_client = httpx.Client(transport=transport, timeout=API_TIMEOUT)
+
+    return _api_client
+
+def api_request(method: str, url: str, headers: dict | None = None, retry: bool = True, **kwargs) -> httpx.Response:
+
+    '''
+    Send an authenticated request to a Google Cloud REST API, retrying
+    `RETRY_STATUSES` and dropped connections with exponential backoff, and
+    raising `httpx.HTTPStatusError` if it still fails. Pass `retry=False` for
+    creates that have no idempotency key, where a retry after a lost response
+    would create a duplicate.
+    '''
+
+    attempts = MAX_RETRIES + 1 if retry else 1
+
+    for attempt in range(attempts):
+        request_headers = {'Authorization': f'Bearer {get_access_token()}', **(headers or dict())}
+
+        try:
+            r = get_api_client().request(method, url, headers=request_headers, **kwargs)
+        except (httpx.ReadError, httpx.RemoteProtocolError):
+            if attempt == attempts - 1:
+                raise
+        else:
+            if r.status_code not in RETRY_STATUSES or attempt == attempts - 1:
+                break
+
+        time.sleep(BACKOFF_FACTOR * 2 ** attempt)
+
+    r.raise_for_status()
+
+    return r
+
+def query_parameter(name: str, parameter_type: str, value: str) -> dict:
+
+    '''
+    Build a named scalar BigQuery query parameter in its REST representation.
+    '''
+
+    return {
+        'name': name,
+        'parameterType': {'type': parameter_type},
+        'parameterValue': {'value': value},
+    }
+
+def run_query(query: str, query_parameters: list | None = None) -> None:
+
+    '''
+    Run a GoogleSQL query or script with `jobs.query` and wait for it to
+    finish, long-polling `getQueryResults` if it outlasts the first call.
+    Success is decided by the job's status, as the `errors` field in the
+    query response can also carry warnings.
+    '''
+
+    # requestId makes a retried jobs.query call reuse the first job instead
+    # of running the query again.
+    body = {
+        'query': query,
+        'useLegacySql': False,
+        'timeoutMs': BQ_POLL_TIMEOUT_MS,
+        'requestId': str(uuid.uuid4()),
+    }
+
+    if query_parameters:
+        body['parameterMode'] = 'NAMED'
+        body['queryParameters'] = query_parameters
+
+    response = api_request('POST', f'{BQ_API_URL}/projects/{BQ_PROJECT_NAME}/queries', json=body).json()
+
+    job_reference = response['jobReference']
+
+    while not response['jobComplete']:
+        response = api_request(
+            'GET',
+            f'{BQ_API_URL}/projects/{BQ_PROJECT_NAME}/queries/{job_reference["jobId"]}',
+            params={'location': job_reference['location'], 'timeoutMs': BQ_POLL_TIMEOUT_MS, 'maxResults': 0},
+        ).json()
+
+    wait_for_job(job_reference)
+
+def wait_for_job(job_reference: dict) -> None:
+
+    '''
+    Poll a BigQuery job with `jobs.get` until it's done, raising if it failed.
+    '''
+
+    while True:
+        job = api_request(
+            'GET',
+            f'{BQ_API_URL}/projects/{BQ_PROJECT_NAME}/jobs/{job_reference["jobId"]}',
+            params={'location': job_reference['location']} if 'location' in job_reference else None,
+        ).json()
+
+        if job['status']['state'] == 'DONE':
+            break
+
+        time.sleep(BQ_POLL_INTERVAL)
+
+    if 'errorResult' in job['status']:
+        raise RuntimeError(f'BigQuery job failed: {job["status"]["errorResult"]}')
+
+def run_job(configuration: dict) -> None:
+
+    '''
+    Insert a BigQuery job (e.g. a load job) and poll it until it's done. The
+    job ID is generated here, so if a retried insert finds the job already
+    exists (the first attempt's response was lost) it's simply waited on.
+    '''
+
+    job_reference = {'projectId': BQ_PROJECT_NAME, 'jobId': str(uuid.uuid4())}
+
+    try:
+        job = api_request(
+            'POST',
+            f'{BQ_API_URL}/projects/{BQ_PROJECT_NAME}/jobs',
+            json={'jobReference': job_reference, 'configuration': configuration},
+        ).json()
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code != httpx.codes.CONFLICT:
+            raise
+    else:
+        job_reference = job['jobReference']
+
+    wait_for_job(job_reference)
+
+def gcs_object_url(bucket_name: str, object_name: str) -> str:
+
+    '''
+    Return the JSON API URL of a GCS object.
+    '''
+
+    return f'{GCS_API_URL}/storage/v1/b/{bucket_name}/o/{quote(object_name, safe="")}'
+
+def gcs_prefix_exists(bucket_name: str, prefix: str) -> bool:
+
+    '''
+    Return whether any object in the bucket has a name starting with `prefix`.
+    '''
+
+    response = api_request(
+        'GET',
+        f'{GCS_API_URL}/storage/v1/b/{bucket_name}/o',
+        params={'prefix': prefix, 'maxResults': 1, 'fields': 'items/name'},
+    ).json()
+
+    return bool(response.get('items'))
+
+def upload_to_gcs(bucket_name: str, object_name: str, data: bytes, content_type: str, **params) -> None:
+
+    '''
+    Upload `data` as a GCS object with a single media upload. Extra keyword
+    arguments are passed through as `objects.insert` query parameters.
+    '''
+
+    api_request(
+        'POST',
+        f'{GCS_API_URL}/upload/storage/v1/b/{bucket_name}/o',
+        params={'uploadType': 'media', 'name': object_name, **params},
+        headers={'Content-Type': content_type},
+        content=data,
+    )
+
+async def get_data(client: httpx.AsyncClient, semaphore: asyncio.Semaphore, url: str, http_cache: dict) -> tuple[list, list, list]:
 
     '''
     Send a request to The River's website to get the last 10 songs played
-    and load the times, songs, and artists into lists to be loaded to a
-    dataframe in a later function.
+    and load the times, songs, and artists into lists to be written to a
+    CSV in a later function. The request is conditional on the validators
+    saved in `http_cache` from the last run; if the page hasn't changed the
+    server answers 304 and nothing is parsed. On a 200, `http_cache` is
+    updated in place with the new validators.
     '''
 
-    r = requests.get(url)
-    soup = BeautifulSoup(r.text, 'html.parser')
- 
+    headers = dict()
+    validators = http_cache.get(url, dict())
+
+    if validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
+
+    async with semaphore:
+        for attempt in range(MAX_RETRIES + 1):
+            r = await client.get(url, headers=headers)
+
+            if r.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                break
+
+            await asyncio.sleep(BACKOFF_FACTOR * 2 ** attempt)
+
     times = list()
     songs = list()
     artists = list()
 
-    for time in soup.find_all('time'):
-        times.append(time['datetime'])
+    if r.status_code == httpx.codes.NOT_MODIFIED:
+        return times, songs, artists
+
+    # Out of retries, or an error that isn't worth retrying: fail the run
+    # rather than parse an error page into an empty playlist.
+    r.raise_for_status()
+
+    if not r.content:
+        return times, songs, artists
 
-    for song in soup.find_all('div', {'class': 'lsp-item-title bold font_size_sm'}):
-        songs.append(song.text)
+    if r.status_code == httpx.codes.OK:
+        http_cache[url] = {
+            'etag': r.headers.get('ETag'),
+            'last_modified': r.headers.get('Last-Modified'),
+        }
 
-    for artist in soup.find_all('div', {'class': 'lsp-item-artist font_size_sm'}):
-        artists.append(artist.text)
+    # One precompiled XPath union walks the tree once and returns the matching
+    # tags in document order; each is routed to its list.
+    for element in PLAYLIST_XPATH(lxml.html.fromstring(r.content)):
+        if element.tag == 'time':
+            times.append(element.attrib['datetime'])
+        elif element.attrib['class'].split() == SONG_CLASS.split():
+            songs.append(element.text_content())
+        else:
+            artists.append(element.text_content())
 
     # logger.info(f'Lists created:\nTimes:\n{times}\nSongs:\n{songs}\nArtists:\n{artists}')
 
     return times, songs, artists
 
-def create_dataframe(times: list, songs: list, artists: list) -> pd.DataFrame:
+def create_http_client() -> httpx.AsyncClient:
 
     '''
-    Take in the lists generated from scraping the website and create a dataframe
-    from them, while also setting the `TimePlayed` data type to datetime.
+    Build the HTTP client shared by every request in a run. Its connection
+    pool keeps connections (and TLS sessions) open between pages and retries,
+    and the transport retries failed connection attempts.
     '''
 
-    playlist = pd.DataFrame(zip(songs, artists, times), columns=['Song', 'Artist', 'TimePlayed'])
-    playlist['TimePlayed'] = pd.to_datetime(playlist['TimePlayed'])
-    playlist = playlist.loc[playlist['Song'] != 'UPICKSTART']
+    limits = httpx.Limits(
+        max_connections=MAX_CONCURRENT_REQUESTS,
+        max_keepalive_connections=MAX_CONCURRENT_REQUESTS,
+    )
+    transport = httpx.AsyncHTTPTransport(retries=MAX_RETRIES, limits=limits)
 
-    return playlist
+    return httpx.AsyncClient(transport=transport, timeout=REQUEST_TIMEOUT, follow_redirects=True)
 
-def create_file_in_gcs_bucket() -> tuple[str, str]:
+async def get_all_data(urls: list, http_cache: dict) -> tuple[list, list, list]:
 
     '''
-    Run the scraping and dataframe creation functions, create a CSV file,
-    and load the file to the GCS bucket.
+    Scrape every page in `urls` concurrently over one HTTP client and combine
+    the results, so adding a station costs the slowest response rather than
+    the sum of them.
     '''
-    times, songs, artists  = get_data(URL)
-    playlist = create_dataframe(times, songs, artists)
 
-    storage_client = storage.Client()
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
 
-    file_timestamp = datetime.strftime(datetime.now(), '%Y%m%d%H%M%S')
+    async with create_http_client() as client:
+        results = await asyncio.gather(*(get_data(client, semaphore, url, http_cache) for url in urls))
+
+    times = list()
+    songs = list()
+    artists = list()
 
-    bucket_name = GCS_BUCKET_NAME
+    for page_times, page_songs, page_artists in results:
+        times.extend(page_times)
+        songs.extend(page_songs)
+        artists.extend(page_artists)
 
-    bucket = storage_client.bucket(bucket_name)
-    file_name = f'{FILE_BASE_NAME}_{file_timestamp}.csv'
-    uri = f'gs://{GCS_BUCKET_NAME}/{file_name}'
+    return times, songs, artists
+
+async def get_playlists(urls: list) -> list[list[tuple[str, str, str]]]:
 
-    blob = bucket.blob(file_name)
-    
-    blob.upload_from_string(playlist.to_csv(index=False), 'text/csv')
+    '''
+    Scrape every page in `urls` concurrently, like `get_all_data`, but keep
+    each page's rows separate and skip the conditional-GET cache, since the
+    BigQuery remote function needs every page's full playlist.
+    '''
 
-    storage_client.close()
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
 
-    return blob, uri
+    async with create_http_client() as client:
+        results = await asyncio.gather(*(get_data(client, semaphore, url, dict()) for url in urls))
 
-def main(argv=None) -> str:
-    blob, uri = create_file_in_gcs_bucket()
+    return [create_rows(times, songs, artists) for times, songs, artists in results]
 
-    external_query = f'''
-        CREATE OR REPLACE EXTERNAL TABLE
-            `{BQ_PROJECT_NAME}.RAW_DATA.{TABLE_NAME}`
-        OPTIONS (
-            format = 'CSV',
-            skip_leading_rows = 1,
-            uris = ['{uri}']
-        )
+def create_rows(times: list, songs: list, artists: list) -> list[tuple[str, str, str]]:
+
+    '''
+    Take in the lists generated from scraping the website and zip them into
+    (Song, Artist, TimePlayed) rows, dropping the `UPICKSTART` placeholder
+    rows. `TimePlayed` is left as the ISO-8601 string from the page; BigQuery
+    parses it on load. Duplicate rows (e.g. the same page scraped from two
+    URLs) are dropped here, keeping the first, so BigQuery doesn't have to.
+    '''
+
+    rows = ((s, a, t) for s, a, t in zip(songs, artists, times) if s != 'UPICKSTART')
+
+    return list(dict.fromkeys(rows))
+
+def create_csv(rows: list[tuple[str, str, str]]) -> str:
+
+    '''
+    Write the playlist rows out as CSV text for the archive.
+    '''
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+
+    writer.writerow(['Song', 'Artist', 'TimePlayed'])
+    writer.writerows(rows)
+
+    return buffer.getvalue()
+
+def partition_datamart_table() -> None:
+
+    '''
+    One-off migration that rebuilds DATAMART partitioned by `DatePlayed`, so
+    the MERGE in `merge_into_datamart` only scans recent partitions instead of
+    the whole history. The rebuilt table is clustered on `RowId`, the MERGE's
+    match key, if `add_datamart_row_ids` has already added it, and on `Song`
+    and `Artist` otherwise, so the two migrations can run in either order and
+    this one can be re-run without undoing the `RowId` clustering. BigQuery
+    won't change the partitioning of an existing table in place, so the data
+    is copied to a new table (`LIKE` the old one, to carry its description,
+    labels and column descriptions over) which then takes the old one's name.
+    The copy's row count is checked first, and the old table is kept with
+    an `_UNPARTITIONED` suffix rather than dropped; check it (including any
+    policy tags) and drop it by hand.
+    '''
+
+    table = api_request(
+        'GET',
+        f'{BQ_API_URL}/projects/{BQ_PROJECT_NAME}/datasets/DATAMART/tables/{TABLE_NAME}',
+        params={'fields': 'schema'},
+    ).json()
+
+    if any(field['name'] == 'RowId' for field in table['schema']['fields']):
+        cluster_by = 'RowId'
+    else:
+        cluster_by = 'Song, Artist'
+
+    partition_query = f'''
+        CREATE TABLE
+            `{BQ_PROJECT_NAME}.DATAMART.{TABLE_NAME}_PARTITIONED`
+        LIKE
+            `{BQ_PROJECT_NAME}.DATAMART.{TABLE_NAME}`
+        PARTITION BY
+            DatePlayed
+        CLUSTER BY
+            {cluster_by}
+        AS
+        SELECT
+            *
+        FROM
+            `{BQ_PROJECT_NAME}.DATAMART.{TABLE_NAME}`
+        ;
+
+        ASSERT (
+            SELECT
+                COUNT(*)
+            FROM
+                `{BQ_PROJECT_NAME}.DATAMART.{TABLE_NAME}_PARTITIONED`
+        ) = (
+            SELECT
+                COUNT(*)
+            FROM
+                `{BQ_PROJECT_NAME}.DATAMART.{TABLE_NAME}`
+        ) AS 'Partitioned copy of DATAMART.{TABLE_NAME} has a different row count'
+        ;
+
+        ALTER TABLE
+            `{BQ_PROJECT_NAME}.DATAMART.{TABLE_NAME}`
+        RENAME TO
+            {TABLE_NAME}_UNPARTITIONED
+        ;
+
+        ALTER TABLE
+            `{BQ_PROJECT_NAME}.DATAMART.{TABLE_NAME}_PARTITIONED`
+        RENAME TO
+            {TABLE_NAME}
         ;
     '''
 
-    external_client = bigquery.Client()
+    run_query(partition_query)
 
-    external_client.query(external_query)
-    external_client.close()
+def add_datamart_row_ids() -> None:
 
-    staging_query = f'''
-        TRUNCATE TABLE
-            `{BQ_PROJECT_NAME}.STAGING.{TABLE_NAME}`
+    '''
+    One-off migration that adds the `RowId` dedup key to DATAMART, fills it in
+    for existing rows, and reclusters the table on it so the MERGE in
+    `merge_into_datamart` can match on one INT64 instead of four columns.
+    `partition_datamart_table` keeps this clustering, whichever of the two
+    runs first.
+    '''
+
+    row_id_query = f'''
+        ALTER TABLE
+            `{BQ_PROJECT_NAME}.DATAMART.{TABLE_NAME}`
+        ADD COLUMN IF NOT EXISTS
+            RowId INT64
         ;
 
-        INSERT
-            `{BQ_PROJECT_NAME}.STAGING.{TABLE_NAME}`
+        UPDATE
+            `{BQ_PROJECT_NAME}.DATAMART.{TABLE_NAME}`
+        SET
+            RowId = {ROW_ID_SQL}
+        WHERE
+            RowId IS NULL
+        ;
+    '''
+
+    run_query(row_id_query)
+
+    api_request(
+        'PATCH',
+        f'{BQ_API_URL}/projects/{BQ_PROJECT_NAME}/datasets/DATAMART/tables/{TABLE_NAME}',
+        json={'clustering': {'fields': ['RowId']}},
+    )
+
+def datamart_merge_query(source: str, since: str) -> str:
+
+    '''
+    Build the MERGE that inserts any rows from `source` (a query returning
+    distinct `Song`, `Artist` and `TimePlayed` timestamp rows) that aren't
+    already in DATAMART, splitting `TimePlayed` into its date and time parts
+    on the way in. Rows are matched on their `RowId` key. Only rows played on
+    or after the `since` date expression are compared, on both sides, so
+    BigQuery can prune DATAMART's partitions.
+    '''
+
+    return f'''
+        MERGE
+            `{BQ_PROJECT_NAME}.DATAMART.{TABLE_NAME}` AS D
+        USING (
+            SELECT
+                *,
+                {ROW_ID_SQL} AS RowId
+            FROM (
+                SELECT
+                    Song,
+                    Artist,
+                    DATE(TimePlayed) AS DatePlayed,
+                    TIME(TimePlayed) AS TimePlayed
+                FROM (
+                    {source}
+                )
+                WHERE
+                    DATE(TimePlayed) >= {since}
+            )
+        ) AS S
+        ON
+            D.DatePlayed >= {since}
+            AND
+            D.RowId = S.RowId
+        WHEN NOT MATCHED THEN
+            INSERT (Song, Artist, DatePlayed, TimePlayed, AudTs, AudUser, RowId)
+            VALUES (S.Song, S.Artist, S.DatePlayed, S.TimePlayed, CURRENT_TIMESTAMP(), SESSION_USER(), S.RowId)
+        ;
+    '''
+
+def merge_into_datamart(source: str, since: date, query_parameters: list | None = None) -> None:
+
+    '''
+    Run the DATAMART MERGE for `source`, comparing rows played on or after
+    `since`.
+    '''
+
+    datamart_query = datamart_merge_query(source, '@since')
+
+    run_query(datamart_query, [query_parameter('since', 'DATE', since.isoformat()), *(query_parameters or [])])
+
+def load_data_to_datamart(rows: list[tuple[str, str, str]]) -> None:
+
+    '''
+    MERGE the scraped rows into DATAMART. The rows are sent as a query
+    parameter, so they land with a single query job and no staging table.
+    Only the last `LOOKBACK_DAYS` are compared; the page never lists songs
+    older than that.
+    '''
+
+    if not rows:
+        return
+
+    rows_parameter = {
+        'name': 'rows',
+        'parameterType': {
+            'type': 'ARRAY',
+            'arrayType': {
+                'type': 'STRUCT',
+                'structTypes': [
+                    {'name': 'Song', 'type': {'type': 'STRING'}},
+                    {'name': 'Artist', 'type': {'type': 'STRING'}},
+                    {'name': 'TimePlayed', 'type': {'type': 'STRING'}},
+                ],
+            },
+        },
+        'parameterValue': {
+            'arrayValues': [
+                {
+                    'structValues': {
+                        'Song': {'value': song},
+                        'Artist': {'value': artist},
+                        'TimePlayed': {'value': time_played},
+                    },
+                }
+                for song, artist, time_played in rows
+            ],
+        },
+    }
+
+    source = '''
         SELECT
             Song,
             Artist,
-            DATE(TimePlayed) AS DatePlayed,
-            TIME(TimePlayed) AS TimePlayed
+            TIMESTAMP(TimePlayed) AS TimePlayed
         FROM
-            `{BQ_PROJECT_NAME}.RAW_DATA.{TABLE_NAME}`
-        ;
+            UNNEST(@rows)
     '''
 
-    staging_client = bigquery.Client()
-        
-    staging_client.query(staging_query)
-    staging_client.close()
+    since = datetime.now(timezone.utc).date() - timedelta(days=LOOKBACK_DAYS)
 
-    datamart_query = f'''
-        INSERT
-            `{BQ_PROJECT_NAME}.DATAMART.{TABLE_NAME}`
+    merge_into_datamart(source, since, [rows_parameter])
+
+def load_archive_to_staging(file_date: str) -> bool:
+
+    '''
+    Load every archived CSV from `file_date` (YYYYMMDD) into STAGING with a
+    single WRITE_TRUNCATE load job, so a day's worth of scrapes is loaded by
+    one batch rather than one job per run. Returns False without loading if
+    nothing was archived that day (`scrape` was down, or every fetch was a
+    304), since a load from a wildcard that matches nothing fails.
+    '''
+
+    if not gcs_prefix_exists(GCS_ARCHIVE_BUCKET_NAME, f'{FILE_BASE_NAME}_{file_date}'):
+        return False
+
+    run_job({
+        'load': {
+            'sourceUris': [f'gs://{GCS_ARCHIVE_BUCKET_NAME}/{FILE_BASE_NAME}_{file_date}*.csv'],
+            'destinationTable': {
+                'projectId': BQ_PROJECT_NAME,
+                'datasetId': 'STAGING',
+                'tableId': TABLE_NAME,
+            },
+            'sourceFormat': 'CSV',
+            'skipLeadingRows': 1,
+            'writeDisposition': 'WRITE_TRUNCATE',
+            'schema': {
+                'fields': [
+                    {'name': 'Song', 'type': 'STRING'},
+                    {'name': 'Artist', 'type': 'STRING'},
+                    {'name': 'TimePlayed', 'type': 'TIMESTAMP'},
+                ],
+            },
+        },
+    })
+
+    return True
+
+def load_archive_to_datamart(file_date: str) -> None:
+
+    '''
+    Batch-load every CSV archived on `file_date` (YYYYMMDD) through STAGING
+    into DATAMART. Consecutive files overlap heavily, so rows are
+    deduplicated on the way out of STAGING. Does nothing if no files were
+    archived that day.
+    '''
+
+    if not load_archive_to_staging(file_date):
+        return
+
+    source = f'''
         SELECT DISTINCT
             Song,
             Artist,
-            DatePlayed,
-            TimePlayed,
-            CURRENT_TIMESTAMP() AS AudTs,
-            SESSION_USER() AS AudUser
+            TimePlayed
         FROM
-            `{BQ_PROJECT_NAME}.STAGING.{TABLE_NAME}` AS S
-        WHERE
-            NOT EXISTS (
-                SELECT
-                    1
-                FROM
-                    `{BQ_PROJECT_NAME}.DATAMART.{TABLE_NAME}`
-                WHERE
-                    Song = S.Song
-                    AND
-                    Artist = S.Artist
-                    AND
-                    DatePlayed = S.DatePlayed
-                    AND
-                    TimePlayed = S.TimePlayed
-            )
+            `{BQ_PROJECT_NAME}.STAGING.{TABLE_NAME}`
+    '''
+
+    since = datetime.strptime(file_date, '%Y%m%d').date() - timedelta(days=LOOKBACK_DAYS)
+
+    merge_into_datamart(source, since)
+
+def read_http_cache() -> dict:
+
+    '''
+    Read the ETag/Last-Modified validators saved by the previous run, keyed
+    by URL. Returns an empty cache if none have been saved yet.
+    '''
+
+    try:
+        r = api_request('GET', gcs_object_url(GCS_BUCKET_NAME, HTTP_CACHE_FILE_NAME), params={'alt': 'media'})
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code == httpx.codes.NOT_FOUND:
+            return dict()
+        raise
+
+    return r.json()
+
+def write_http_cache(http_cache: dict) -> None:
+
+    '''
+    Save the validators for the next run's conditional requests.
+    '''
+
+    upload_to_gcs(GCS_BUCKET_NAME, HTTP_CACHE_FILE_NAME, json.dumps(http_cache).encode('utf-8'), 'application/json')
+
+def archive_playlist(playlist: str) -> str:
+
+    '''
+    Write the playlist CSV to the archive bucket for retention. The file is
+    uploaded there directly, so nothing has to be copied or deleted later,
+    and gzipped with `Content-Encoding: gzip` so it's still served as CSV.
+    '''
+
+    file_timestamp = datetime.strftime(datetime.now(), '%Y%m%d%H%M%S')
+    file_name = f'{FILE_BASE_NAME}_{file_timestamp}.csv'
+
+    # ifGenerationMatch=0 makes the write create-only, so a retried or
+    # overlapping run can't overwrite an archived file in the same RPC.
+    upload_to_gcs(
+        GCS_ARCHIVE_BUCKET_NAME,
+        file_name,
+        gzip.compress(playlist.encode('utf-8'), compresslevel=6),
+        'text/csv',
+        contentEncoding='gzip',
+        ifGenerationMatch=0,
+    )
+
+    return f'gs://{GCS_ARCHIVE_BUCKET_NAME}/{file_name}'
+
+def scheduled_query() -> str:
+
+    '''
+    Build the scheduled query that replaces the Python pipeline: it calls the
+    `REMOTE_FUNCTION_NAME` remote function for each of `URLS` and MERGEs the
+    returned playlists straight into DATAMART, with no GCS or staging table.
+    '''
+
+    source = f'''
+        SELECT DISTINCT
+            JSON_VALUE(PlaylistRow, '$.Song') AS Song,
+            JSON_VALUE(PlaylistRow, '$.Artist') AS Artist,
+            TIMESTAMP(JSON_VALUE(PlaylistRow, '$.TimePlayed')) AS TimePlayed
+        FROM
+            UNNEST({json.dumps(URLS)}) AS Url,
+            UNNEST(JSON_QUERY_ARRAY(`{REMOTE_FUNCTION_NAME}`(Url))) AS PlaylistRow
+    '''
+
+    return datamart_merge_query(source, f'DATE_SUB(CURRENT_DATE(), INTERVAL {LOOKBACK_DAYS} DAY)')
+
+def find_transfer_config(transfer_configs_url: str, display_name: str) -> dict | None:
+
+    '''
+    Return the scheduled query transfer config named `display_name`, or None
+    if there isn't one.
+    '''
+
+    params = {'dataSourceIds': 'scheduled_query'}
+
+    while True:
+        response = api_request('GET', transfer_configs_url, params=params).json()
+
+        for transfer_config in response.get('transferConfigs', list()):
+            if transfer_config['displayName'] == display_name:
+                return transfer_config
+
+        if not response.get('nextPageToken'):
+            return None
+
+        params['pageToken'] = response['nextPageToken']
+
+def create_scheduled_pipeline() -> None:
+
+    '''
+    One-off setup for the BigQuery-only pipeline: register `bq_get_playlist`
+    (deployed as its own Cloud Function) as a BigQuery remote function and
+    schedule `scheduled_query` to run every `SCHEDULE`. Safe to re-run: an
+    existing schedule is updated rather than duplicated. Once it's running,
+    the `main` Cloud Function and its scheduler can be retired.
+    '''
+
+    remote_function_query = f'''
+        CREATE OR REPLACE FUNCTION
+            `{REMOTE_FUNCTION_NAME}`(url STRING)
+        RETURNS
+            STRING
+        REMOTE WITH CONNECTION
+            `{BQ_PROJECT_NAME}.{BQ_LOCATION}.{BQ_CONNECTION_NAME}`
+        OPTIONS (
+            endpoint = '{REMOTE_FUNCTION_ENDPOINT}'
+        )
         ;
     '''
 
-    datamart_client = bigquery.Client()
+    run_query(remote_function_query)
+
+    transfer_configs_url = f'{BQ_DATA_TRANSFER_API_URL}/projects/{BQ_PROJECT_NAME}/locations/{BQ_LOCATION}/transferConfigs'
+    transfer_config = {
+        'displayName': SCHEDULED_QUERY_NAME,
+        'dataSourceId': 'scheduled_query',
+        'schedule': SCHEDULE,
+        'params': {'query': scheduled_query()},
+    }
+
+    # Update the schedule in place if this has been run before, so re-running
+    # the setup never leaves two scheduled MERGEs racing each other.
+    existing_config = find_transfer_config(transfer_configs_url, SCHEDULED_QUERY_NAME)
+
+    if existing_config is None:
+        api_request('POST', transfer_configs_url, json=transfer_config, retry=False)
+    else:
+        api_request(
+            'PATCH',
+            f'{BQ_DATA_TRANSFER_API_URL}/{existing_config["name"]}',
+            params={'updateMask': 'schedule,params'},
+            json=transfer_config,
+        )
+
+def bq_get_playlist(request) -> tuple[dict, int]:
+
+    '''
+    HTTP Cloud Function behind the `REMOTE_FUNCTION_NAME` BigQuery remote
+    function. BigQuery sends a batch of `calls`, each holding one URL, and
+    gets back one reply per call: a JSON array of that page's
+    {Song, Artist, TimePlayed} rows. Failures that won't go away on a retry
+    get a 400, which BigQuery doesn't retry: a malformed request, or a page
+    that answers with a 4xx other than 408/429. A page that can't be reached
+    or answers 408/429/5xx gets a 503, and anything else a 500; BigQuery
+    retries both.
+    '''
 
-    datamart_client.query(datamart_query)
-    datamart_client.close()
+    try:
+        urls = [url for url, in request.get_json(silent=True)['calls']]
+    except (KeyError, TypeError, ValueError) as e:
+        return {'errorMessage': f'Malformed calls payload: {e}'}, 400
 
-    archive_client = storage.Client()
+    try:
+        playlists = asyncio.run(get_playlists(urls))
+    except httpx.HTTPStatusError as e:
+        status_code = e.response.status_code
 
-    bucket = archive_client.get_bucket(GCS_BUCKET_NAME)
-    archive_bucket = archive_client.get_bucket(GCS_ARCHIVE_BUCKET_NAME)
-    bucket.copy_blob(blob, archive_bucket, blob.name)
+        if e.response.is_client_error and status_code not in NON_PERMANENT_CLIENT_ERRORS:
+            return {'errorMessage': f'Failed to fetch playlist: {e}'}, 400
 
-    bucket.delete_blob(blob.name)
+        return {'errorMessage': f'Failed to fetch playlist: {e}'}, 503
+    except httpx.HTTPError as e:
+        return {'errorMessage': f'Failed to fetch playlist: {e}'}, 503
+    except Exception as e:
+        return {'errorMessage': str(e)}, 500
+
+    replies = [
+        json.dumps([{'Song': s, 'Artist': a, 'TimePlayed': t} for s, a, t in rows])
+        for rows in playlists
+    ]
+
+    return {'replies': replies}, 200
+
+def scrape(argv=None) -> str:
+
+    '''
+    Scrape the playlist and only archive it, leaving the BigQuery load to
+    the daily `load_archive` run. Use this in place of `main` when scraping
+    often enough that a query job per run isn't worth it.
+    '''
+
+    http_cache = read_http_cache()
+    previous_http_cache = dict(http_cache)
+
+    times, songs, artists = asyncio.run(get_all_data(URLS, http_cache))
+    rows = create_rows(times, songs, artists)
+
+    if rows:
+        archive_playlist(create_csv(rows))
+
+    if http_cache != previous_http_cache:
+        write_http_cache(http_cache)
+
+    return '0'
+
+def load_archive(argv=None) -> str:
+
+    '''
+    Daily batch companion to `scrape`: load all of yesterday's archived
+    files into DATAMART at once.
+    '''
+
+    file_date = datetime.strftime(datetime.now() - timedelta(days=1), '%Y%m%d')
+
+    load_archive_to_datamart(file_date)
+
+    return '0'
+
+async def run_pipeline(urls: list) -> None:
+
+    '''
+    Scrape `urls`, then MERGE the rows into DATAMART and archive the CSV at
+    the same time. The two don't depend on each other, so the archive upload
+    runs while BigQuery is busy with the MERGE. If no page has changed since
+    the last run there's nothing new to load and both are skipped. The HTTP
+    validators are only saved once the rows have landed, so a failed run is
+    retried in full next time.
+    '''
+
+    http_cache = await asyncio.to_thread(read_http_cache)
+    previous_http_cache = dict(http_cache)
+
+    times, songs, artists = await get_all_data(urls, http_cache)
+    rows = create_rows(times, songs, artists)
+
+    if rows:
+        await asyncio.gather(
+            asyncio.to_thread(load_data_to_datamart, rows),
+            asyncio.to_thread(archive_playlist, create_csv(rows)),
+        )
+
+    if http_cache != previous_http_cache:
+        await asyncio.to_thread(write_http_cache, http_cache)
+
+def main(argv=None) -> str:
+    asyncio.run(run_pipeline(URLS))
 
     return '0'
 